@@ -1,11 +1,25 @@
-import itertools
+import contextlib
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
+from torch.nn.attention import SDPBackend, sdpa_kernel
 from timm.models.layers import DropPath as TimmDropPath, to_2tuple, trunc_normal_
 from typing import Tuple
 
+# TF32 matmuls/convs on Ampere+; no-op elsewhere
+torch.set_float32_matmul_precision('high')
+torch.backends.cudnn.allow_tf32 = True
+
+# tanh-approximate GELU, roughly half the cost of the erf form on the wide MLP activations
+gelu_tanh = functools.partial(nn.GELU, approximate='tanh')
+
+# Attention always passes an additive float bias: CUDA flash rejects it and
+# falls through to mem-efficient, while the CPU flash kernel accepts it and
+# beats math there; math stays as fallback for shapes/dtypes they reject
+_SDPA_BACKENDS = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+
 
 class Conv2d_BN(torch.nn.Sequential):
     def __init__(self, a, b, ks=1, stride=1, pad=0, dilation=1,
@@ -26,7 +40,8 @@ class Conv2d_BN(torch.nn.Sequential):
         b = bn.bias - bn.running_mean * bn.weight / \
             (bn.running_var + bn.eps)**0.5
         m = torch.nn.Conv2d(w.size(1) * self.c.groups, w.size(
-            0), w.shape[2:], stride=self.c.stride, padding=self.c.padding, dilation=self.c.dilation, groups=self.c.groups)
+            0), w.shape[2:], stride=self.c.stride, padding=self.c.padding, dilation=self.c.dilation, groups=self.c.groups,
+            device=w.device, dtype=w.dtype)
         m.weight.data.copy_(w)
         m.bias.data.copy_(b)
 
@@ -38,6 +53,17 @@ class DropPath(TimmDropPath):
         super().__init__(drop_prob=drop_prob)
         self.drop_prob = drop_prob
 
+    def forward(self, x):
+        if not self.training or not self.drop_prob:
+            return x
+        # one per-sample keep mask broadcast over the remaining dims
+        keep_prob = 1 - self.drop_prob
+        mask = x.new_empty((x.shape[0],) + (1,) * (x.ndim - 1)).bernoulli_(keep_prob)
+        if keep_prob > 0.:
+            mask.div_(keep_prob)
+
+        return x.mul_(mask)
+
     def __repr__(self):
         msg = super().__repr__()
         msg += f'(drop_prob={self.drop_prob})'
@@ -45,6 +71,18 @@ class DropPath(TimmDropPath):
         return msg
 
 
+def _replace_modules(root, cls, fn):
+    # Swap every submodule of type cls for fn(module) in its parent.
+    for name, m in list(root.named_modules()):
+        if isinstance(m, cls):
+            parent_name, _, child = name.rpartition('.')
+            parent = root.get_submodule(parent_name)
+            if isinstance(parent, nn.Sequential):
+                parent[int(child)] = fn(m)
+            else:
+                setattr(parent, child, fn(m))
+
+
 class PatchEmbed(nn.Module):
     def __init__(self, in_chans, embed_dim, resolution, activation):
         super().__init__()
@@ -94,8 +132,7 @@ class MBConv(nn.Module):
         x = self.conv2(x); x = self.act2(x)
         x = self.conv3(x)
         x = self.drop_path(x)
-        x += shortcut
-        x = self.act3(x)
+        x = self.act3(x + shortcut)
 
         return x
 
@@ -149,7 +186,7 @@ class ConvLayer(nn.Module):
 
     def forward(self, x):
         for blk in self.blocks:
-            x = checkpoint.checkpoint(blk, x) if self.use_checkpoint else blk(x)
+            x = checkpoint.checkpoint(blk, x, use_reentrant=False) if self.use_checkpoint else blk(x)
         if self.downsample is not None:
             x = self.downsample(x)
 
@@ -158,23 +195,40 @@ class ConvLayer(nn.Module):
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None,
-                 out_features=None, act_layer=nn.GELU, drop=0.):
+                 out_features=None, act_layer=gelu_tanh, drop=0.):
         super().__init__()
         out_features = out_features or in_features
         hidden_features = hidden_features or in_features
 
-        self.norm = nn.LayerNorm(in_features)
         self.fc1 = nn.Linear(in_features, hidden_features)
         self.fc2 = nn.Linear(hidden_features, out_features)
         self.act = act_layer()
-        self.drop = nn.Dropout(drop)
+        self.drop = nn.Dropout(drop) if drop > 0. else nn.Identity()
 
     def forward(self, x):
-        x = self.norm(x)
+        # expects pre-normed input (TinyViTBlock.norm2)
+        shape = x.shape
+        # Linear on a 2-D input takes the addmm fast path
+        x = x.reshape(-1, shape[-1])
         x = self.fc1(x); x = self.act(x); x = self.drop(x)
         x = self.fc2(x); x = self.drop(x)
 
-        return x
+        return x.view(*shape[:-1], -1)
+
+
+@functools.lru_cache(maxsize=None)
+def _attention_bias_idxs(resolution: Tuple[int, int]) -> torch.Tensor:
+    # [N, N] offset index per query/key pair, shared by every Attention with
+    # the same window. int32 is the narrowest dtype tensor indexing accepts.
+    ys, xs = torch.meshgrid(torch.arange(resolution[0]), torch.arange(resolution[1]),
+                            indexing='ij')
+    points = torch.stack([ys.flatten(), xs.flatten()], 1)
+    offsets = (points[:, None, :] - points[None, :, :]).abs()
+    # every |offset| first appears in raster order from point (0, 0), so
+    # dy * W + dx matches the first-seen numbering of attention_biases
+    idxs = offsets[..., 0] * resolution[1] + offsets[..., 1]
+
+    return idxs.int()
 
 
 class Attention(nn.Module):
@@ -189,46 +243,40 @@ class Attention(nn.Module):
         self.d = int(attn_ratio * key_dim)
         self.dh = self.d * num_heads
         self.attn_ratio = attn_ratio
+        self.resolution = tuple(resolution)
 
         self.norm = nn.LayerNorm(dim)
         self.qkv = nn.Linear(dim, self.dh + self.nh_kd * 2)
         self.proj = nn.Linear(self.dh, dim)
 
-        points = list(itertools.product(range(resolution[0]), range(resolution[1])))
-        N = len(points)
-        attention_offsets = {}
-        idxs = []
-        for p1 in points:
-            for p2 in points:
-                offset = (abs(p1[0] - p2[0]), abs(p1[1] - p2[1]))
-                attention_offsets.setdefault(offset, len(attention_offsets))
-                idxs.append(attention_offsets[offset])
-
-        self.attention_biases = nn.Parameter(torch.zeros(num_heads, len(attention_offsets)))
-        self.register_buffer('attention_bias_idxs',
-                             torch.LongTensor(idxs).view(N, N), persistent=False)
+        self.attention_biases = nn.Parameter(torch.zeros(num_heads, resolution[0] * resolution[1]))
+        self.register_buffer('attention_bias_idxs', _attention_bias_idxs(self.resolution),
+                             persistent=False)
+        # eval-mode cache of the gathered bias, [1, heads, N, N] ready for SDPA
+        self.register_buffer('ab', None, persistent=False)
 
     @torch.no_grad()
     def train(self, mode=True):
         super().train(mode)
-        if mode and hasattr(self, 'ab'):
-            del self.ab
-        else:
-            self.ab = self.attention_biases[:, self.attention_bias_idxs]
+        self.ab = None if mode else \
+            self.attention_biases[:, self.attention_bias_idxs].unsqueeze(0).contiguous()
+
+        return self
 
     def forward(self, x):
         B, N, C = x.shape
         x = self.norm(x)
-        qkv = self.qkv(x)
+        qkv = self.qkv(x.reshape(B * N, C)).view(B, N, -1)
 
         q, k, v = qkv.view(B, N, self.num_heads, -1).split(
             [self.key_dim, self.key_dim, self.d], dim=3)
         q, k, v = [t.permute(0, 2, 1, 3) for t in (q, k, v)]
-        attn = (q @ k.transpose(-2, -1)) * self.scale \
-               + (self.attention_biases[:, self.attention_bias_idxs] if self.training else self.ab)
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).transpose(1, 2).reshape(B, N, self.dh)
-        x = self.proj(x)
+        bias = self.attention_biases[:, self.attention_bias_idxs].unsqueeze(0) \
+               if self.training else self.ab
+        # self.scale == key_dim ** -0.5 is SDPA's default scaling for q/k of width key_dim
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=bias)
+        x = x.transpose(1, 2).reshape(B * N, self.dh)
+        x = self.proj(x).view(B, N, C)
 
         return x
 
@@ -236,54 +284,82 @@ class Attention(nn.Module):
 class TinyViTBlock(nn.Module):
     def __init__(self, dim, input_resolution, num_heads, window_size=7,
                  mlp_ratio=4., drop=0., drop_path=0., local_conv_size=3,
-                 activation=nn.GELU):
+                 activation=gelu_tanh, use_checkpoint=False):
         super().__init__()
         self.dim = dim; self.input_resolution = input_resolution
         self.num_heads = num_heads; self.window_size = window_size
-        self.mlp_ratio = mlp_ratio
+        self.mlp_ratio = mlp_ratio; self.use_checkpoint = use_checkpoint
         self.drop_path = DropPath(drop_path) if drop_path > 0 else nn.Identity()
         head_dim = dim // num_heads
         self.attn = Attention(dim, head_dim, num_heads,
                               attn_ratio=1,
                               resolution=(window_size, window_size))
+        # registered right before mlp so parameter order (and optimizer state)
+        # matches checkpoints from when this norm lived inside Mlp
+        self.norm2 = nn.LayerNorm(dim)
         self.mlp = Mlp(in_features=dim, hidden_features=int(dim*mlp_ratio),
                        act_layer=activation, drop=drop)
         pad = local_conv_size // 2
         self.local_conv = Conv2d_BN(dim, dim, ks=local_conv_size,
                                     stride=1, pad=pad, groups=dim)
 
+        # window grid is fixed by input_resolution
+        H, W = input_resolution
+        self.pad_b = (window_size - H % window_size) % window_size
+        self.pad_r = (window_size - W % window_size) % window_size
+        self.nH = (H + self.pad_b) // window_size
+        self.nW = (W + self.pad_r) // window_size
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints keep norm2 as mlp.norm
+        for k in ('weight', 'bias'):
+            if prefix + 'mlp.norm.' + k in state_dict:
+                state_dict[prefix + 'norm2.' + k] = state_dict.pop(prefix + 'mlp.norm.' + k)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _forward_mlp(self, x):
+        return self.mlp(self.norm2(x))
+
+    def _forward_same_window(self, x):
+        # window covers the whole feature map: attend over all tokens directly
+        return self.attn(x)
+
+    def _forward_windowed(self, x):
+        # pad, window-partition, attend, unpartition; one copy each way
+        # unless padding has to be cropped off again
+        B, L, C = x.shape
+        H, W = self.input_resolution
+        ws, nH, nW = self.window_size, self.nH, self.nW
+        x = x.view(B, H, W, C)
+        if self.pad_b or self.pad_r:
+            x = F.pad(x, (0,0,0,self.pad_r,0,self.pad_b))
+        x = x.view(B, nH, ws, nW, ws, C).permute(0, 1, 3, 2, 4, 5)\
+             .reshape(B*nH*nW, ws*ws, C)
+        x = self.attn(x)
+        x = x.view(B, nH, nW, ws, ws, C).permute(0, 1, 3, 2, 4, 5)
+        if self.pad_b or self.pad_r:
+            x = x.reshape(B, nH*ws, nW*ws, C)[:, :H, :W]
+
+        return x.reshape(B, L, C)
+
     def forward(self, x):
         B, L, C = x.shape
         H, W = self.input_resolution
         assert L == H*W
         res = x
-        if H == self.window_size and W == self.window_size:
-            x = self.attn(x)
-        else:
-            # pad, window-partition, attend, unpartition
-            x = x.view(B, H, W, C)
-            pad_b = (self.window_size - H % self.window_size) % self.window_size
-            pad_r = (self.window_size - W % self.window_size) % self.window_size
-            if pad_b or pad_r:
-                x = F.pad(x, (0,0,0,pad_r,0,pad_b))
-            pH, pW = H+pad_b, W+pad_r
-            nH, nW = pH//self.window_size, pW//self.window_size
-            x = x.view(B, nH, self.window_size, nW, self.window_size, C)\
-                 .transpose(2,3)\
-                 .reshape(B*nH*nW, self.window_size*self.window_size, C)
-            x = self.attn(x)
-            x = x.view(B, nH, nW, self.window_size, self.window_size, C)\
-                 .transpose(2,3)\
-                 .reshape(B, pH, pW, C)
-            if pad_b or pad_r:
-                x = x[:, :H, :W].contiguous()  
-            x = x.view(B, L, C)
+        # Only the attention and MLP sublayers are checkpointed: they hold the
+        # large activations, and local_conv's BN must not update stats twice.
+        attn = self._forward_same_window if H == self.window_size and W == self.window_size \
+               else self._forward_windowed
+        x = checkpoint.checkpoint(attn, x, use_reentrant=False) if self.use_checkpoint else attn(x)
 
         x = res + self.drop_path(x)
         x = x.transpose(1,2).reshape(B, C, H, W)
         x = self.local_conv(x)
         x = x.view(B, C, L).transpose(1,2)
-        x = x + self.drop_path(self.mlp(x))
+        h = checkpoint.checkpoint(self._forward_mlp, x, use_reentrant=False) if self.use_checkpoint \
+            else self._forward_mlp(x)
+        x = x + self.drop_path(h)
 
         return x
 
@@ -292,24 +368,25 @@ class BasicLayer(nn.Module):
     def __init__(self, dim, input_resolution, depth, num_heads,
                  window_size, mlp_ratio=4., drop=0., drop_path=0.,
                  downsample=None, use_checkpoint=False,
-                 local_conv_size=3, activation=nn.GELU, out_dim=None):
+                 local_conv_size=3, activation=gelu_tanh, out_dim=None):
         super().__init__()
+        self.dim = dim; self.input_resolution = input_resolution
         self.blocks = nn.ModuleList([
             TinyViTBlock(dim=dim, input_resolution=input_resolution,
                          num_heads=num_heads, window_size=window_size,
                          mlp_ratio=mlp_ratio, drop=drop,
                          drop_path=drop_path[i] if isinstance(drop_path,list) else drop_path,
                          local_conv_size=local_conv_size,
-                         activation=activation)
+                         activation=activation,
+                         use_checkpoint=use_checkpoint)
             for i in range(depth)])
         self.downsample = downsample(input_resolution, dim=dim,
                                      out_dim=out_dim, activation=activation) \
                           if downsample else None
-        self.use_checkpoint = use_checkpoint
 
     def forward(self, x):
         for blk in self.blocks:
-            x = checkpoint.checkpoint(blk, x) if self.use_checkpoint else blk(x)
+            x = blk(x)
         if self.downsample is not None:
             x = self.downsample(x)
 
@@ -324,12 +401,14 @@ class LayerNorm2d(nn.Module):
         self.eps = eps
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        u = x.mean(1, keepdim=True)
-        s = (x - u).pow(2).mean(1, keepdim=True)
-        x = (x - u) / torch.sqrt(s + self.eps)
-        x = self.weight[:, None, None] * x + self.bias[:, None, None]
+        # single fused layer_norm over channels, statistics in fp32 so
+        # reduced-precision inputs don't lose range; NHWC<->NCHW permutes are
+        # views for channels-last inputs and the result stays channels-last
+        dtype = x.dtype
+        x = x.permute(0, 2, 3, 1).float()
+        x = F.layer_norm(x, (x.size(-1),), self.weight.float(), self.bias.float(), self.eps)
 
-        return x
+        return x.permute(0, 3, 1, 2).to(dtype)
 
 
 class TinyViT(nn.Module):
@@ -338,21 +417,25 @@ class TinyViT(nn.Module):
                  num_heads=[3,6,12,24], window_sizes=[7,7,14,7],
                  mlp_ratio=4., drop_rate=0., drop_path_rate=0.1,
                  use_checkpoint=False, mbconv_expand_ratio=4.0,
-                 local_conv_size=3, layer_lr_decay=1.0):
+                 local_conv_size=3, layer_lr_decay=1.0, use_checkpoint_conv=False):
         super().__init__()
         self.img_size = img_size
         self.num_classes = num_classes
         self.depths = depths
         self.num_layers = len(depths)
         self.mlp_ratio = mlp_ratio
-        activation = nn.GELU
+        # Opt-in inference-time autocast dtype (None keeps fp32); prefer bf16,
+        # which avoids the fp16 overflow ViTs hit around softmax, on GPUs that
+        # support it. Training AMP is left to the caller.
+        self.autocast_dtype = None
+        activation = gelu_tanh
 
         # Patch Embedding
         self.patch_embed = PatchEmbed(in_chans, embed_dims[0], img_size, activation)
         self.patches_resolution = self.patch_embed.patches_resolution
 
         # Stochastic Depth Schedule
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, sum(depths))]
+        dpr = torch.linspace(0, drop_path_rate, sum(depths)).tolist()
 
         # Build Stages
         self.layers = nn.ModuleList()
@@ -364,7 +447,9 @@ class TinyViT(nn.Module):
                           depth=depths[i_layer],
                           drop_path=dpr[sum(depths[:i_layer]):sum(depths[:i_layer+1])],
                           downsample=PatchMerging if i_layer < self.num_layers-1 else None,
-                          use_checkpoint=use_checkpoint,
+                          # use_checkpoint covers the attention stages, where activation
+                          # memory lives; the cheap MBConv stage only on request
+                          use_checkpoint=use_checkpoint_conv if is_conv else use_checkpoint,
                           out_dim=embed_dims[min(i_layer+1, len(embed_dims)-1)],
                           activation=activation)
             if is_conv:
@@ -393,6 +478,22 @@ class TinyViT(nn.Module):
         self.apply(self._init_weights)
         self.set_layer_lr_decay(layer_lr_decay)
 
+        # All convs run channels-last, so local_conv/PatchMerging outputs map
+        # back to [B, L, C] tokens and on to the neck without copies
+        self.to(memory_format=torch.channels_last)
+
+    def _apply(self, *args, **kwargs):
+        super()._apply(*args, **kwargs)
+        # _apply (.to/.cuda/...) converts every Attention's buffer separately;
+        # re-point equal-window blocks at one converted index tensor
+        shared = {}
+        for m in self.modules():
+            if isinstance(m, Attention):
+                idxs = m.attention_bias_idxs
+                m.attention_bias_idxs = shared.setdefault((m.resolution, idxs.device), idxs)
+
+        return self
+
     def _init_weights(self, m):
         if isinstance(m, nn.Linear):
             trunc_normal_(m.weight, std=.02)
@@ -422,15 +523,85 @@ class TinyViT(nn.Module):
             p.param_name = k
         self.apply(lambda m: [hasattr(p,'lr_scale') or AssertionError(p.param_name) for p in m.parameters()])
 
-    def forward_features(self, x):
-        x = self.patch_embed(x)
-        for layer in self.layers:
-            x = layer(x)
-        B,_,C = x.size()
-        x = x.view(B,64,64,C).permute(0,3,1,2)
-        x = self.neck(x)
+    @torch.no_grad()
+    def fuse(self):
+        # Inference only: folds every Conv2d_BN into a plain Conv2d using the
+        # BN running stats, so the model must not be trained afterwards.
+        _replace_modules(self, Conv2d_BN, lambda m: m.fuse())
+        self.to(memory_format=torch.channels_last)
+        self.eval()
+        self._swap_droppath_for_inference()
+
+        return self
+
+    def compile_regions(self, types=(PatchMerging, Mlp), **kwargs):
+        # Regional alternative to compile_for_inference: compiles each module
+        # of the given types in place (fullgraph, static shapes) so Inductor
+        # fuses their pointwise ops into the surrounding kernels (e.g. Mlp
+        # becomes addmm -> gelu epilogue -> addmm) while the rest of the
+        # model stays eager. Call after fuse() for inference.
+        kwargs = dict(dict(fullgraph=True, dynamic=False), **kwargs)
+        for m in self.modules():
+            if isinstance(m, types):
+                m.compile(**kwargs)
+
+        return self
 
-        return x
+    @torch.no_grad()
+    def quantize_int8(self, backend='x86'):
+        # CPU inference only: fuses, then swaps every nn.Linear (qkv, proj,
+        # fc1/fc2) for a dynamic int8 one with per-channel weight scales.
+        # Activation scales are taken per batch, so no calibration pass is needed.
+        from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+        torch.backends.quantized.engine = backend
+        self.fuse()
+        self.autocast_dtype = None  # quantized kernels take fp32 activations
+
+        return quantize_dynamic(self, {nn.Linear: per_channel_dynamic_qconfig},
+                                dtype=torch.qint8, inplace=True)
+
+    def _swap_droppath_for_inference(self):
+        # DropPath is the identity in eval; drop the module call altogether.
+        # Irreversible, so only for models that won't be trained again.
+        _replace_modules(self, DropPath, lambda m: nn.Identity())
+
+    def compile_for_inference(self, mode='reduce-overhead', fullgraph=False):
+        # Fuses, switches to eval and returns the torch.compile'd model. Input
+        # shapes must stay fixed (dynamic=False) for the captured CUDA graphs.
+        self.fuse()
+
+        return torch.compile(self, mode=mode, fullgraph=fullgraph, dynamic=False)
+
+    def forward_features(self, x):
+        dtype = x.dtype
+        amp = torch.autocast(x.device.type, dtype=self.autocast_dtype) \
+              if self.autocast_dtype is not None and not self.training else contextlib.nullcontext()
+        with amp:
+            x = x.to(memory_format=torch.channels_last)
+            x = self.patch_embed(x)
+            with sdpa_kernel(_SDPA_BACKENDS):
+                for layer in self.layers:
+                    x = layer(x)
+            B,_,C = x.size()
+            H,W = self.layers[-1].input_resolution
+            # tokens viewed as NCHW are already channels-last: no copy before the neck
+            x = x.view(B,H,W,C).permute(0,3,1,2)
+            x = self.neck(x)
+
+        return x.to(dtype)
 
     def forward(self, x):
         return self.forward_features(x)
+
+
+def prepare_teacher(model, mode='reduce-overhead'):
+    # Freezes a distillation teacher (any nn.Module; TinyViT also gets fused)
+    # and compiles it. Inputs must keep a fixed shape, including the image size,
+    # since the CUDA graphs captured by 'reduce-overhead' are static.
+    # Run it under torch.inference_mode() and a bf16 autocast.
+    model.eval().requires_grad_(False)
+    if isinstance(model, TinyViT):
+        model.fuse()
+
+    return torch.compile(model, mode=mode, dynamic=False)
@@ -14,7 +14,7 @@ from PIL import Image
 from tqdm.auto import tqdm
 
 from segment_anything import sam_model_registry
-from model import TinyViT
+from model import TinyViT, prepare_teacher
 
 # ===============================
 # Constants for SAM pre-processing
@@ -75,6 +75,13 @@ def save_checkpoint(state, out_dir: Path, epoch: int):
     torch.save(state, fname)
     logging.info(f"Saved checkpoint: {fname}")
 
+def teacher_forward(teacher, imgs, use_bf16: bool):
+    """Run the frozen teacher and return fp32 latents usable as a loss target."""
+    with torch.inference_mode(), torch.autocast(imgs.device.type, dtype=torch.bfloat16, enabled=use_bf16):
+        latents = teacher(imgs)
+    # Copy out of inference mode (and the CUDA graph output pool) so autograd can save it
+    return latents.to(torch.float32, copy=True)
+
 def parse_args():
     p = argparse.ArgumentParser(description="Train miniSAM model via knowledge distillation")
     p.add_argument("--img-dir",    type=Path, required=True, help="Directory containing training images")
@@ -233,6 +240,11 @@ def _train_model(
         sam = sam_model_registry["vit_h"](checkpoint=str(sam_checkpoint))
         sam.to(device).eval()
         logging.info("SAM teacher model loaded successfully")
+        # Compiled + bf16 teacher only pays off on GPU
+        teacher = sam.image_encoder
+        teacher_bf16 = use_amp and device.type == "cuda" and torch.cuda.is_bf16_supported()
+        if device.type == "cuda":
+            teacher = prepare_teacher(teacher)
     except Exception as e:
         logging.error(f"Failed to load SAM model: {e}")
         return False
@@ -246,6 +258,8 @@ def _train_model(
         window_sizes=[7,7,14,7],
         drop_path_rate=0.0
     ).to(device)
+    # Validate the student at the same precision as the teacher
+    student.autocast_dtype = torch.bfloat16 if teacher_bf16 else None
 
     optimizer = AdamW(student.parameters(), lr=lr, weight_decay=weight_decay)
     scheduler = CosineAnnealingLR(optimizer, T_max=epochs)
@@ -300,8 +314,7 @@ def _train_model(
                 imgs = imgs.to(device, non_blocking=True)
 
                 # 1) teacher forward
-                with torch.no_grad():
-                    teacher_latents = sam.image_encoder(imgs)
+                teacher_latents = teacher_forward(teacher, imgs, teacher_bf16)
 
                 # 2) student forward + loss
                 optimizer.zero_grad()
@@ -326,7 +339,7 @@ def _train_model(
             with torch.no_grad():
                 for imgs in tqdm(val_loader, desc=f"Epoch {epoch}/{epochs} [val]  ", leave=False):
                     imgs = imgs.to(device, non_blocking=True)
-                    teacher_latents = sam.image_encoder(imgs)
+                    teacher_latents = teacher_forward(teacher, imgs, teacher_bf16)
                     preds = student(imgs)
                     total_val_loss += criterion(preds, teacher_latents).item()
 